@@ -1,72 +1,315 @@
 import streamlit as st
-import google.generativeai as genai
 from PIL import Image
-import pandas as pd
 import requests
-from docx import Document
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import io
+import os
+import re
 
 # --- CONFIGURATION ---
 st.set_page_config(page_title="Smart Halal Scanner", page_icon="🤖")
 
+DEFAULT_MODEL = "models/gemini-1.5-flash-latest"
+
+OFF_SEARCH_URL = "https://world.openfoodfacts.org/cgi/search.pl"
+
 # --- SIDEBAR: API SETUP ---
 with st.sidebar:
     st.header("⚙️ Settings")
     api_key = st.text_input("Enter Google Gemini API Key", type="password")
     st.info("Get your free key at: aistudio.google.com")
     
-    # Configure the AI if key is present
-    if api_key:
-        genai.configure(api_key=api_key)
-
 # --- FUNCTIONS ---
 
-def analyze_image_with_ai(image):
+def configure_ai(api_key):
+    """
+    Points the Gemini SDK at this session's key. The SDK config is global,
+    so this runs on every rerun rather than being cached.
+    """
+    import google.generativeai as genai  # heavy import, deferred until a key is entered
+    genai.configure(api_key=api_key)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def supported_models(api_key):
+    """
+    Lists the models this key can use to read an image with generateContent.
+    Cached, so the network round-trip happens once per hour, not per rerun.
+    """
+    import google.generativeai as genai
+    configure_ai(api_key)
+    return [
+        m.name for m in genai.list_models()
+        if 'generateContent' in m.supported_generation_methods and is_vision_model(m.name)
+    ]
+
+def is_vision_model(name):
+    """
+    True for Gemini models that accept image input. Gemini 1.0 Pro is
+    text-only unless it is the '-vision' variant; embedding, TTS and audio
+    models don't read images either.
+    """
+    short = name.split("/")[-1]
+    if not short.startswith("gemini-"):
+        return False
+    if any(tag in short for tag in ("embedding", "tts", "audio")):
+        return False
+    if short.startswith(("gemini-pro", "gemini-1.0-pro")):
+        return "vision" in short
+    return True
+
+@st.cache_resource
+def get_model(model_name, api_key):
+    """
+    Builds the Gemini model once per name and key, shared across reruns.
+    A model keeps the client from its first call, so the key is part of the cache key.
+    """
+    import google.generativeai as genai
+    configure_ai(api_key)
+    return genai.GenerativeModel(model_name)
+
+# Configure the AI if key is present
+model_name = DEFAULT_MODEL
+if api_key:
+    configure_ai(api_key)
+    from google.api_core import exceptions as google_errors
+    # Remember a rejected key so it isn't retried on every rerun;
+    # network hiccups are not remembered and are retried next time
+    model_errors = st.session_state.setdefault('model_list_errors', {})
+    models = []
+    if api_key in model_errors:
+        st.sidebar.warning(f"Could not list models for this key, using {DEFAULT_MODEL}: {model_errors[api_key]}")
+    else:
+        try:
+            models = supported_models(api_key)
+        except (google_errors.Unauthenticated, google_errors.PermissionDenied, google_errors.InvalidArgument) as e:
+            model_errors[api_key] = str(e)
+            st.sidebar.warning(f"Could not list models for this key, using {DEFAULT_MODEL}: {e}")
+        except Exception as e:
+            st.sidebar.warning(f"Could not list models right now, using {DEFAULT_MODEL}: {e}")
+    if models:
+        with st.sidebar:
+            default_index = models.index(DEFAULT_MODEL) if DEFAULT_MODEL in models else 0
+            model_name = st.selectbox("Gemini model", models, index=default_index)
+
+def prepare_image_for_ai(image, max_side=1024):
+    """
+    Shrinks the photo and re-encodes it as JPEG (without EXIF) so the upload
+    to Gemini is small. Label text stays readable at this size.
+    Returned as a raw blob: a PIL image would be re-encoded by the SDK as lossless WebP.
+    """
+    img = image.copy()
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        # Flatten onto white; a plain RGB convert turns transparent areas black
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    img = img.convert('RGB')
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+# We ask the AI to be a Halal Auditor
+AI_PROMPT = """
+Analyze this product image for a Halal verification database. 
+Extract the following details into a strict pattern:
+Product Name: [Name]
+Ingredients: [List ingredients if visible, otherwise write 'Not Visible']
+Manufacturer: [Company Name]
+Country of Origin: [Country Name, look for 'Made in' or addresses]
+Halal Status: [Yes if 'Halal' logo/text is found, otherwise 'No']
+
+If the text is cut off or blurry, just infer what you can.
+"""
+
+def stream_ai_analysis(image_bytes, model_name):
+    """
+    Streams Gemini's answer chunk by chunk. Stops reading as soon as all five
+    fields have a complete line, instead of waiting for the full response.
+    """
+    import google.generativeai as genai
+    image = Image.open(io.BytesIO(image_bytes))
+    response = get_model(model_name, api_key).generate_content(
+        [AI_PROMPT, prepare_image_for_ai(image)],
+        generation_config=genai.GenerationConfig(max_output_tokens=512, temperature=0),
+        stream=True
+    )
+    buffer = ""
+    for chunk in response:
+        buffer += chunk.text
+        yield chunk.text
+        # A field only counts once its line has ended
+        done = {m.group(1).lower() for m in AI_FIELD_RE.finditer(buffer) if "\n" in buffer[m.end(2):]}
+        if len(done) == len(AI_FIELDS):
+            break
+
+def analyze_image_with_ai(image_bytes, image_hash):
     """
     Uses Gemini AI to look at the image and extract data like a human would.
+    The answer is shown as it streams in and remembered per image content,
+    so analyzing the same photo again skips the API call.
     """
     if not api_key:
         return None, "Please enter an API Key first."
     
-    model = genai.GenerativeModel('gemini-1.5-flash-latest')
-    
-    # We ask the AI to be a Halal Auditor
-    prompt = """
-    Analyze this product image for a Halal verification database. 
-    Extract the following details into a strict pattern:
-    Product Name: [Name]
-    Ingredients: [List ingredients if visible, otherwise write 'Not Visible']
-    Manufacturer: [Company Name]
-    Country of Origin: [Country Name, look for 'Made in' or addresses]
-    Halal Status: [Yes if 'Halal' logo/text is found, otherwise 'No']
-    
-    If the text is cut off or blurry, just infer what you can.
-    """
+    results = st.session_state.setdefault('ai_results', {})
+    key = (model_name, image_hash)
+    if key in results:
+        return results[key], None
     
     try:
-        response = model.generate_content([prompt, image])
-        return response.text, None
+        text = st.write_stream(stream_ai_analysis(image_bytes, model_name))
     except Exception as e:
         return None, str(e)
+    results[key] = text
+    return text, None
+
+@st.cache_resource
+def get_session():
+    """
+    One pooled, keep-alive session for all OpenFoodFacts lookups.
+    Held in cache_resource because Streamlit re-executes this script on every rerun.
+    """
+    session = requests.Session()
+    session.headers.update({"User-Agent": "SahihBN/1.0"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    ))
+    return session
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def search_openfoodfacts(product_name):
     """
     Searches the global OpenFoodFacts database for the product name.
+    Network and parse errors raise, so they are never cached as "not found".
     """
-    url = f"https://world.openfoodfacts.org/cgi/search.pl?search_terms={product_name}&search_simple=1&action=process&json=1"
-    try:
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        if data['products']:
-            product = data['products'][0] # Take the first best match
-            return {
-                "Ingredients": product.get('ingredients_text', 'Not found in DB'),
-                "Country": product.get('countries', 'Unknown'),
-                "Manufacturer": product.get('brands', 'Unknown')
-            }
+    params = {
+        "search_terms": product_name,
+        "search_simple": 1,
+        "action": "process",
+        "json": 1,
+        "fields": "ingredients_text,countries,brands"
+    }
+    response = get_session().get(OFF_SEARCH_URL, params=params, timeout=(3, 7))
+    response.raise_for_status()
+    data = response.json()
+    if data.get('products'):
+        product = data['products'][0] # Take the first best match
+        return {
+            "Ingredients": product.get('ingredients_text', 'Not found in DB'),
+            "Country": product.get('countries', 'Unknown'),
+            "Manufacturer": product.get('brands', 'Unknown')
+        }
+    return None
+
+@st.cache_data(show_spinner=False)
+def to_excel(record):
+    """
+    Serializes the verified record to XLSX bytes for download.
+    Cached on the record, so reruns don't rebuild the file.
+    """
+    import pandas as pd  # only needed once the user downloads
+    df = pd.DataFrame([record])
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}}) as writer:
+        df.to_excel(writer, index=False, sheet_name='Halal Data')
+    return output.getvalue()
+
+REPORT_FIELDS = ("Product Name", "Ingredients", "Manufacturer", "Country", "Halal Certified")
+
+@st.cache_data(show_spinner=False)
+def to_word(record):
+    """
+    Builds the 'Category | Details' report for the verified record as .docx bytes.
+    Cached on the record, so reruns don't rebuild the file.
+    """
+    from docx import Document  # only needed once the user downloads
+    doc = Document()
+    doc.add_heading('Halal Verification Report', 0)
+    table = doc.add_table(rows=1 + len(REPORT_FIELDS), cols=2)
+    table.style = 'Table Grid'
+    table.cell(0, 0).text = 'Category'
+    table.cell(0, 1).text = 'Details'
+    for row, field in enumerate(REPORT_FIELDS, start=1):
+        table.cell(row, 0).text = field
+        table.cell(row, 1).text = str(record.get(field, ""))
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+@st.cache_resource
+def prefetch_executor():
+    """
+    One shared worker pool for speculative database searches. Analyze never
+    waits on it unless the prefetched result is actually used.
+    """
+    return ThreadPoolExecutor(max_workers=2)
+
+# Shared patterns for the file-name guess. Streamlit re-runs this script on every
+# rerun, so these lines run again too; re's internal cache skips the recompile.
+FILENAME_SEP_RE = re.compile(r"[_\-.]+")
+LETTER_RE = re.compile(r"[A-Za-z]")
+NON_ALNUM_RE = re.compile(r"[^0-9a-z]+")
+# Default names from cameras and messaging apps, e.g. 'WhatsApp Image 2024-01-01 at 10.10.10.jpeg'
+CAMERA_PREFIXES = frozenset((
+    "IMG", "DSC", "DSCN", "PXL", "MVIMG", "PANO", "PHOTO", "IMAGE", "SCREENSHOT",
+    "WHATSAPP", "SIGNAL", "TELEGRAM", "SCAN", "CAMERA", "UNTITLED"
+))
+
+def guess_product_name(filename):
+    """
+    Guesses a product name from the upload's file name so the database
+    search can start while the AI is still reading the image.
+    Camera-style names like 'IMG_1234.jpg' give no usable guess.
+    """
+    stem = os.path.splitext(filename or "")[0]
+    words = [w for w in FILENAME_SEP_RE.sub(" ", stem).split() if not w.isdigit()]
+    if not words or words[0].upper() in CAMERA_PREFIXES:
         return None
-    except:
+    guess = " ".join(words)
+    if len(LETTER_RE.findall(guess)) < 3:
         return None
+    return guess
+
+def normalize_name(name):
+    """
+    Lowercases a product name and collapses punctuation and spacing.
+    """
+    return " ".join(NON_ALNUM_RE.sub(" ", name.casefold()).split())
+
+def same_product(guess, product_name):
+    """
+    Checks whether the guessed name and the AI's product name are the same
+    once case and punctuation are ignored. Partial matches don't count:
+    'chocolate' is not 'Cadbury Dairy Milk Chocolate'.
+    """
+    if not guess or not product_name:
+        return False
+    return normalize_name(guess) == normalize_name(product_name)
+
+# Maps the labels in the AI's answer to our field names
+AI_FIELDS = {
+    "product name": "Product Name",
+    "ingredients": "Ingredients",
+    "manufacturer": "Manufacturer",
+    "country of origin": "Country",
+    "halal status": "Halal Certified"
+}
+# One pass over the whole answer; tolerates markdown bullets/bold and '1.' numbering
+# around the labels. Only spaces/tabs, never newlines, so a blank field can't
+# swallow the next line.
+AI_FIELD_RE = re.compile(
+    r"^[ \t*#>-]*(?:\d+[.)][ \t*]*)?(product name|ingredients|manufacturer|country of origin|halal status)\**[ \t]*:[ \t]*\**[ \t]*(.*?)[ \t]*$",
+    re.I | re.M
+)
+# 'Yes' anywhere in the status, e.g. '[Yes]' or 'logo found, so Yes'
+YES_RE = re.compile(r"\byes\b", re.I)
 
 def parse_ai_response(text):
     """
@@ -80,19 +323,15 @@ def parse_ai_response(text):
         "Halal Certified": False
     }
     
-    lines = text.split('\n')
-    for line in lines:
-        if "Product Name:" in line:
-            data["Product Name"] = line.split(":", 1)[1].strip()
-        elif "Ingredients:" in line:
-            data["Ingredients"] = line.split(":", 1)[1].strip()
-        elif "Manufacturer:" in line:
-            data["Manufacturer"] = line.split(":", 1)[1].strip()
-        elif "Country of Origin:" in line:
-            data["Country"] = line.split(":", 1)[1].strip()
-        elif "Halal Status:" in line:
-            if "Yes" in line:
-                data["Halal Certified"] = True
+    for match in AI_FIELD_RE.finditer(text):
+        key = AI_FIELDS[match.group(1).lower()]
+        value = match.group(2).strip(" \t\r*")  # markdown bold and CRLF endings
+        if not value:
+            continue  # field left blank by the model
+        if key == "Halal Certified":
+            data[key] = bool(YES_RE.search(value))
+        else:
+            data[key] = value
             
     return data
 
@@ -103,12 +342,23 @@ st.write("Upload a photo. The AI will read it, or we can search the database.")
 uploaded_file = st.file_uploader("Take a picture of the product", type=["jpg", "png", "jpeg"])
 
 if uploaded_file:
-    image = Image.open(uploaded_file)
-    st.image(image, caption='Product Image', use_column_width=True)
+    image_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    
+    # Only a genuinely new upload resets the results; widget reruns reuse them
+    if st.session_state.get('file_hash') != file_hash:
+        st.session_state['file_hash'] = file_hash
+        st.session_state.pop('data', None)
+        st.session_state.pop('final_record', None)
+    
+    st.image(image_bytes, caption='Product Image', use_column_width=True)
 
     if st.button("🚀 Analyze Product"):
         with st.spinner('AI is reading the image (Human-like scanning)...'):
-            raw_text, error = analyze_image_with_ai(image)
+            # Start a speculative database search from the file name while the AI works
+            guessed_name = guess_product_name(uploaded_file.name)
+            prefetch = prefetch_executor().submit(search_openfoodfacts, guessed_name) if guessed_name else None
+            raw_text, error = analyze_image_with_ai(image_bytes, file_hash)
             
             if error:
                 st.error(f"Error: {error}")
@@ -121,7 +371,18 @@ if uploaded_file:
                 db_data = None
                 if extracted_data["Ingredients"] == "Not Visible" or len(extracted_data["Ingredients"]) < 5:
                     st.warning(f"Ingredients not visible in photo. Searching database for '{extracted_data['Product Name']}'...")
-                    db_data = search_openfoodfacts(extracted_data["Product Name"])
+                    # Only wait on the prefetch when it searched for the same product
+                    if prefetch and same_product(guessed_name, extracted_data["Product Name"]):
+                        try:
+                            db_data = prefetch.result()
+                        except (requests.RequestException, ValueError):
+                            db_data = None
+                    # Otherwise, or if it found nothing, search by the AI's product name as before
+                    if db_data is None:
+                        try:
+                            db_data = search_openfoodfacts(extracted_data["Product Name"])
+                        except (requests.RequestException, ValueError):
+                            st.warning("Could not reach the OpenFoodFacts database. Please try again later.")
                     
                     if db_data:
                         st.success("Found details in OpenFoodFacts database!")
@@ -153,15 +414,34 @@ if uploaded_file:
             save_btn = st.form_submit_button("💾 Save Data")
             
             if save_btn:
-                # Prepare final DataFrame
-                final_df = pd.DataFrame([{
+                # Prepare final record
+                final_record = {
                     "Product Name": name,
                     "Ingredients": ing,
                     "Manufacturer": manu,
                     "Country": country,
                     "Halal Certified": "Yes" if halal else "No"
-                }])
+                }
                 
+                st.session_state['final_record'] = final_record
                 st.success("Data saved ready for download!")
-                st.table(final_df)
-                # (Download buttons code is the same as before)
+                st.table([final_record])
+
+        # Download buttons can't live inside a form
+        if 'final_record' in st.session_state:
+            final_record = st.session_state['final_record']
+            col1, col2 = st.columns(2)
+            with col1:
+                st.download_button(
+                    "📥 Download Excel",
+                    data=to_excel(final_record),
+                    file_name="halal_product.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+            with col2:
+                st.download_button(
+                    "📄 Download Word",
+                    data=to_word(final_record),
+                    file_name="halal_product.docx",
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+                )
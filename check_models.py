@@ -1,8 +1,10 @@
 import google.generativeai as genai
 import os
 
-# Put your API KEY here directly just to test
-API_KEY = "Insert API when using"
+# Read the key from the environment so it never ends up in the repo
+API_KEY = os.environ.get("GEMINI_API_KEY")
+if not API_KEY:
+    raise SystemExit("Set the GEMINI_API_KEY environment variable first.")
 genai.configure(api_key=API_KEY)
 
 print("List of available models for you:")